@@ -1,10 +1,33 @@
 import os
+
+# Models run in parallel processes; keep each one's BLAS/OpenMP pool small. This has to be
+# set before numpy is imported, and forked workers inherit it.
+os.environ.setdefault('OMP_NUM_THREADS', '2')
+
+import json
+import math
 import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore import UNSIGNED
 from botocore.config import Config
+from botocore.exceptions import ClientError
 import xarray as xr
-import matplotlib.pyplot as plt
+try:
+    import pygrib
+except ImportError:  # fall back to cfgrib below
+    pygrib = None
+import matplotlib
+matplotlib.use('Agg')  # headless runner; don't probe GUI backends
+matplotlib.rcParams.update({
+    'text.usetex': False,
+    'path.simplify': True,
+    'path.simplify_threshold': 1.0,
+    'agg.path.chunksize': 10000,
+})
+from matplotlib.figure import Figure
 import numpy as np
 from datetime import datetime, timedelta
 
@@ -14,94 +37,341 @@ MODELS = {
         "bucket": "ecmwf-forecasts",
         "type": "ecmwf",
         "path_template": "{date}/{hour}z/aifs/0p25/oper/",
-        "file_pattern": "0p25_oper.grib2"
+        "file_pattern": "0p25_oper.grib2",
+        "vars": {"t": "2t", "u": "10u", "v": "10v"}
     },
     "EAGLE-AIGFS": { # Formerly EAGLE-GraphCast
         "bucket": "noaa-nws-graphcastgfs-pds",
         "type": "noaa",
         "path_template": "graphcastgfs.{date}/{hour}/forecasts_13_levels/",
-        "file_prefix": "graphcastgfs.t{hour}z.pgrb2.0p25.f012"
+        "file_prefix": "graphcastgfs.t{hour}z.pgrb2.0p25.f012",
+        "vars": {"t": "2t", "u": "10u", "v": "10v"}
     },
     "FourCastNet": {
         "bucket": "noaa-nws-fourcastnetgfs-pds",
         "type": "noaa",
         "path_template": "fcngfs.{date}/{hour}/",
-        "file_prefix": "fcngfs.t{hour}z.pgrb2.0p25.f012"
+        "file_prefix": "fcngfs.t{hour}z.pgrb2.0p25.f012",
+        "vars": {"t": "2t", "u": "10u", "v": "10v"}
     }
 }
 
-s3 = boto3.client('s3', config=Config(signature_version=UNSIGNED))
+# GRIB2 files are 100-400 MB; fetch them as parallel 16 MiB byte ranges
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=16 * 1024 * 1024,
+    multipart_chunksize=16 * 1024 * 1024,
+    max_concurrency=16,
+    use_threads=True,
+)
+
+# GRIB messages we actually plot, as they appear in each publisher's index sidecar
+NOAA_FIELDS = {("TMP", "2 m above ground"), ("UGRD", "10 m above ground"), ("VGRD", "10 m above ground")}
+ECMWF_FIELDS = {"2t", "10u", "10v"}
+
+# Variable names to scan for when a model has no "vars" table
+T_NAMES = frozenset({'2t', 't2m', 'tmp'})
+U_NAMES = frozenset({'10u', 'u10', 'ugrd'})
+V_NAMES = frozenset({'10v', 'v10', 'vgrd'})
+
+# cfgrib index sidecars live here so the temp and wind opens reuse one parsed index
+CFGRIB_CACHE_DIR = "assets/.cfgrib-cache"
+CFGRIB_INDEXPATH = CFGRIB_CACHE_DIR + "/{path}.idx"
+
+# Remembers which object each model was last rendered from, so unchanged cycles are skipped
+LAST_RUN_FILE = "assets/.last_run.json"
+
+# Output figure size; fields are decimated to the axes' pixel extent before rendering
+FIGSIZE = (12, 6)
+DPI = 100
+
+# botocore clients can't be shared across processes, so each worker builds its own on first use.
+# Within a process the cycle probes and multipart parts share that client's connection pool.
+_s3 = None
+_s3_lock = threading.Lock()
+
+def get_s3():
+    global _s3
+    with _s3_lock:
+        if _s3 is None:
+            _s3 = boto3.client('s3', config=Config(
+                signature_version=UNSIGNED,
+                max_pool_connections=32,
+                retries={'mode': 'standard', 'max_attempts': 5},
+                tcp_keepalive=True,
+                # Anonymous public data: skip per-part checksumming, TLS already covers transport
+                request_checksum_calculation='when_required',
+                response_checksum_validation='when_required',
+            ))
+    return _s3
+
+# Matplotlib figures are not thread-safe, so each worker gets its own
+_local = threading.local()
+
+def get_figure():
+    """One reusable Figure per thread; built without pyplot, whose global state isn't thread-safe."""
+    if not hasattr(_local, "fig"):
+        _local.fig = Figure(figsize=FIGSIZE, dpi=DPI)
+        _local.ax = _local.fig.subplots()
+    return _local.fig, _local.ax
+
+def head_etag(bucket, key):
+    """Single HEAD request instead of listing the whole prefix; returns the ETag or None."""
+    try:
+        return get_s3().head_object(Bucket=bucket, Key=key)['ETag']
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+
+def find_key(cfg, prefix, hour_str):
+    """Returns (key, etag) of the GRIB2 file for one cycle prefix, or None if it isn't published yet."""
+    if cfg["type"] == "noaa":
+        # NOAA file names are fully determined by the cycle, so just probe the key
+        key = prefix + cfg["file_prefix"].format(hour=hour_str) + ".grib2"
+        etag = head_etag(cfg["bucket"], key)
+        return (key, etag) if etag else None
+
+    paginator = get_s3().get_paginator('list_objects_v2')
+    pages = paginator.paginate(Bucket=cfg["bucket"], Prefix=prefix,
+                               PaginationConfig={'PageSize': 100, 'MaxItems': 100})
+    for page in pages:
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith(".grib2"):
+                return obj['Key'], obj['ETag']
+    return None
+
+def read_index(bucket, key, model_type):
+    """Returns [(offset, length)] for the messages we need, or None if there is no index."""
+    index_key = key[:-len(".grib2")] + ".index" if model_type == "ecmwf" else key + ".idx"
+    try:
+        body = get_s3().get_object(Bucket=bucket, Key=index_key)['Body'].read()
+    except ClientError:
+        return None
+
+    try:
+        return parse_index(body.decode(), model_type) or None
+    except (ValueError, KeyError, IndexError) as e:  # malformed index: just take the whole file
+        print(f"⚠️ Unreadable index s3://{bucket}/{index_key} ({e}), downloading full file.")
+        return None
+
+def parse_index(body, model_type):
+    """Parses an index sidecar into [(offset, length)]; length is None for the file's last message."""
+    ranges = []
+    if model_type == "ecmwf":
+        # One JSON record per message with explicit byte offsets
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            rec = json.loads(line)
+            if rec.get("param") in ECMWF_FIELDS:
+                ranges.append((int(rec["_offset"]), int(rec["_length"])))
+    else:
+        # wgrib2 inventory: "n:offset:date:VAR:level:..." -- a message ends where the next begins.
+        # Sub-messages ("n.1", "n.2") share their parent's offset, so each range runs to the next distinct offset.
+        rows = [line.split(":") for line in body.splitlines() if line.strip()]
+        offsets = sorted({int(row[1]) for row in rows})
+        next_offset = dict(zip(offsets, offsets[1:]))
+        seen = set()
+        for row in rows:
+            start = int(row[1])
+            if (row[3], row[4]) in NOAA_FIELDS and start not in seen:
+                seen.add(start)
+                end = next_offset.get(start)
+                ranges.append((start, end - start if end is not None else None))
+    return ranges
+
+def download_fields(bucket, key, model_type, local_file):
+    """Fetches only the needed GRIB messages via byte ranges, falling back to the whole file."""
+    ranges = read_index(bucket, key, model_type)
+    if not ranges:
+        get_s3().download_file(bucket, key, local_file, Config=TRANSFER_CONFIG)
+        return
+
+    with open(local_file, "wb") as f:
+        for offset, length in ranges:
+            byte_range = f"bytes={offset}-{offset + length - 1}" if length is not None else f"bytes={offset}-"
+            f.write(get_s3().get_object(Bucket=bucket, Key=key, Range=byte_range)['Body'].read())
+
+def fit_to_pixels(data, ax, cbar=None):
+    """Stride-slices a 2D field so it has no more cells than the axes span in output pixels."""
+    # The axes, not the whole figure, are what the raster lands on (title and margins take the rest).
+    # A colorbar narrows the axes after layout, so its width is added back into the budget.
+    bbox = ax.get_window_extent()
+    width = bbox.width + (cbar.ax.get_window_extent().width if cbar else 0)
+    stride_y = max(1, math.ceil(data.shape[0] / bbox.height))
+    stride_x = max(1, math.ceil(data.shape[1] / width))
+    return data[::stride_y, ::stride_x]
+
+def render(data, cmap, vmin, vmax, units, title, path):
+    """Draws one field with a colorbar on this thread's shared Figure and saves it as a PNG."""
+    fig, ax = get_figure()
+    ax.clear()
+    ax.set_axis_off()
+    im = ax.imshow(data, cmap=cmap, vmin=vmin, vmax=vmax, origin='upper', aspect='auto',
+                   interpolation='nearest', rasterized=True)
+    # index.html has no legend of its own, so every map carries its scale
+    cb = fig.colorbar(im, ax=ax, label=units)
+    # Decimate against the axes as laid out with the colorbar; extent stays that of the full grid
+    im.set_data(fit_to_pixels(data, ax, cb))
+    ax.set_title(title)
+    fig.savefig(path, bbox_inches='tight', dpi=DPI, pil_kwargs={'compress_level': 1, 'optimize': False})
+    cb.remove()
+    im.remove()
+
+def read_fields_pygrib(local_file, var_names):
+    """Pulls the three messages straight out of ecCodes, skipping xarray's index build."""
+    gr = pygrib.open(local_file)
+    try:
+        t = gr.select(shortName=var_names["t"], level=2)[0].values
+        u = gr.select(shortName=var_names["u"], level=10)[0].values
+        v = gr.select(shortName=var_names["v"], level=10)[0].values
+    finally:
+        gr.close()
+    return tuple(np.asarray(a, dtype=np.float32) for a in (t, u, v))
+
+def read_fields_cfgrib(local_file, var_names=None):
+    t_keys = {'typeOfLevel': 'heightAboveGround', 'level': 2}
+    w_keys = {'typeOfLevel': 'heightAboveGround', 'level': 10}
+    if var_names:
+        # Only decode the three messages we plot
+        t_keys['shortName'] = var_names["t"]
+        w_keys['shortName'] = [var_names["u"], var_names["v"]]
+    # Both opens share one on-disk index
+    t_ds = xr.open_dataset(local_file, engine='cfgrib',
+                           backend_kwargs={'filter_by_keys': t_keys, 'indexpath': CFGRIB_INDEXPATH})
+    w_ds = xr.open_dataset(local_file, engine='cfgrib',
+                           backend_kwargs={'filter_by_keys': w_keys, 'indexpath': CFGRIB_INDEXPATH})
+
+    if var_names:
+        by_short_name = {ds[n].attrs.get('GRIB_shortName'): ds[n] for ds in (t_ds, w_ds) for n in ds.data_vars}
+        t_da, u_da, v_da = (by_short_name.get(var_names[k]) for k in ("t", "u", "v"))
+    else:
+        # Unknown naming: scan for the usual GRIB variable names
+        t_var = next(iter(set(t_ds.data_vars) & T_NAMES), None)
+        w_names = set(w_ds.data_vars)
+        u_var = next(iter(w_names & U_NAMES), None)
+        v_var = next(iter(w_names & V_NAMES), None)
+        t_da = t_ds[t_var] if t_var else None
+        u_da = w_ds[u_var] if u_var else None
+        v_da = w_ds[v_var] if v_var else None
+
+    # Materialize once as plain arrays so plotting never goes back to the GRIB file
+    t = t_da.load().values.astype(np.float32, copy=False) if t_da is not None else None
+    if u_da is not None and v_da is not None:
+        u = u_da.load().values.astype(np.float32, copy=False)
+        v = v_da.load().values.astype(np.float32, copy=False)
+    else:
+        u = v = None
+    t_ds.close()
+    w_ds.close()
+    return t, u, v
+
+def read_fields(local_file, var_names=None):
+    """Returns (2m temp in K, 10m u, 10m v) as float32 arrays; None where a field is missing.
+
+    var_names maps "t"/"u"/"v" to GRIB shortNames; without it the cfgrib variables are scanned.
+    """
+    if pygrib is not None and var_names:
+        try:
+            return read_fields_pygrib(local_file, var_names)
+        except ValueError:  # pygrib raises this when a message isn't in the file
+            pass
+    return read_fields_cfgrib(local_file, var_names)
+
+def remove_grib(local_file):
+    """Deletes a downloaded GRIB2 file and the cfgrib index built for it, if any."""
+    for path in (local_file, CFGRIB_INDEXPATH.format(path=local_file)):
+        if os.path.exists(path):
+            os.remove(path)
+
+def load_last_run():
+    if not os.path.exists(LAST_RUN_FILE):
+        return {}
+    with open(LAST_RUN_FILE) as f:
+        return json.load(f)
+
+def save_last_run(last_run):
+    with open(LAST_RUN_FILE, "w") as f:
+        json.dump(last_run, f, indent=2)
 
 def get_latest_available_file(model_name, cfg):
-    """Searches last 48 hours for the most recent valid GRIB2 file."""
+    """Searches last 48 hours for the most recent valid GRIB2 file; returns (bucket, key, etag, date, hour)."""
     now = datetime.utcnow()
-    # Check every 6-hour cycle for the last 2 days
+    # Check every 6-hour cycle for the last 2 days, newest first
+    candidates = []
     for delta_hours in range(0, 48, 6):
         test_time = now - timedelta(hours=delta_hours)
         date_str = test_time.strftime("%Y%m%d")
         # Ensure hour is 00, 06, 12, or 18
         hour_str = f"{(test_time.hour // 6) * 6:02d}"
-        
         prefix = cfg["path_template"].format(date=date_str, hour=hour_str)
-        print(f"[{model_name}] Checking s3://{cfg['bucket']}/{prefix}...")
-        
-        resp = s3.list_objects_v2(Bucket=cfg["bucket"], Prefix=prefix)
-        if 'Contents' in resp:
-            # Find a file matching our needs
-            for obj in resp['Contents']:
-                key = obj['Key']
-                if cfg["type"] == "ecmwf" and key.endswith(".grib2"):
-                    return cfg['bucket'], key, date_str, hour_str
-                if cfg["type"] == "noaa" and cfg["file_prefix"] in key and key.endswith(".grib2"):
-                    return cfg['bucket'], key, date_str, hour_str
-    return None, None, None, None
-
-def process_model(name, cfg):
-    bucket, key, date, hour = get_latest_available_file(name, cfg)
-    if not key:
-        print(f"❌ No data found for {name} in the last 48 hours.")
-        return False
-
-    local_file = f"{name}.grib2"
-    print(f"✅ Found! Downloading: {key}")
-    s3.download_file(bucket, key, local_file)
+        candidates.append((date_str, hour_str, prefix))
+
+    print(f"[{model_name}] Checking {len(candidates)} cycles in s3://{cfg['bucket']}/...")
+
+    # Probe all cycles at once so we pay one round-trip of latency instead of eight
+    def probe(candidate):
+        date_str, hour_str, prefix = candidate
+        return date_str, hour_str, find_key(cfg, prefix, hour_str)
+
+    with ThreadPoolExecutor(max_workers=min(16, len(candidates))) as executor:
+        found = [r for r in executor.map(probe, candidates) if r[2]]
+    if found:
+        date_str, hour_str, (key, etag) = max(found, key=lambda r: (r[0], r[1]))
+        return cfg['bucket'], key, etag, date_str, hour_str
+    return None, None, None, None, None
 
+def process_model(name, cfg, last_record=None):
+    """Renders one model's PNGs; returns its [bucket, key, etag] record, or None on failure."""
     try:
-        # Load surface variables only to save memory/time
-        ds = xr.open_dataset(local_file, engine='cfgrib', backend_kwargs={'filter_by_keys': {'typeOfLevel': 'surface'}})
-        
-        # Mapping standard GRIB variable names
-        t_var = next((v for v in ds.data_vars if v in ['2t', 't2m', 'tmp']), None)
-        u_var = next((v for v in ds.data_vars if v in ['10u', 'u10', 'ugrd']), None)
-        v_var = next((v for v in ds.data_vars if v in ['10v', 'v10', 'vgrd']), None)
-
-        # Plot Temperature
-        if t_var:
-            plt.figure(figsize=(12, 6))
-            (ds[t_var] - 273.15).plot(cmap='magma', vmin=-20, vmax=45, add_labels=False)
-            plt.title(f"{name} 2m Temp - {date} {hour}Z")
-            plt.axis('off')
-            plt.savefig(f"assets/{name}_temp.png", bbox_inches='tight')
-            plt.close()
-
-        # Plot Wind Speed
-        if u_var and v_var:
-            plt.figure(figsize=(12, 6))
-            wind = np.sqrt(ds[u_var]**2 + ds[v_var]**2)
-            wind.plot(cmap='viridis', vmin=0, vmax=40, add_labels=False)
-            plt.title(f"{name} 10m Wind - {date} {hour}Z")
-            plt.axis('off')
-            plt.savefig(f"assets/{name}_wind.png", bbox_inches='tight')
-            plt.close()
-        
-        return True
+        bucket, key, etag, date, hour = get_latest_available_file(name, cfg)
+        if not key:
+            print(f"❌ No data found for {name} in the last 48 hours.")
+            return None
+
+        outputs = (f"assets/{name}_temp.png", f"assets/{name}_wind.png")
+        record = [bucket, key, etag]
+        if last_record == record and all(os.path.exists(p) for p in outputs):
+            print(f"⏭️ {name} unchanged since last run ({key}), skipping.")
+            return record
+
+        local_file = f"{name}.grib2"
+        print(f"✅ Found! Downloading: {key}")
+        try:
+            download_fields(bucket, key, cfg["type"], local_file)
+            t, u, v = read_fields(local_file, cfg.get("vars"))
+        finally:
+            # Fields are in RAM now (or the download failed); free the runner's disk before plotting
+            remove_grib(local_file)
+
+        if t is None and u is None:
+            print(f"❌ No temperature or wind fields found for {name} in {key}.")
+            return None
+        if t is not None:
+            # Kelvin -> Celsius in place, staying in float32
+            np.subtract(t, np.float32(273.15), out=t)
+            render(t, 'magma', -20, 45, "°C", f"{name} 2m Temp - {date} {hour}Z", outputs[0])
+        if u is not None:
+            render(np.hypot(u, v), 'viridis', 0, 40, "m/s", f"{name} 10m Wind - {date} {hour}Z", outputs[1])
+
+        return record
     except Exception as e:
         print(f"❌ Error processing {name}: {e}")
-        return False
+        return None
+
+def process_model_unpacked(item):
+    return process_model(*item)
 
 if __name__ == "__main__":
     os.makedirs("assets", exist_ok=True)
-    results = [process_model(n, c) for n, c in MODELS.items()]
+    os.makedirs(CFGRIB_CACHE_DIR, exist_ok=True)
+    last_run = load_last_run()
+    # Each model decodes and plots in its own process: no GIL contention in ecCodes/numpy
+    jobs = [(n, c, last_run.get(n)) for n, c in MODELS.items()]
+    with ProcessPoolExecutor(max_workers=len(MODELS)) as executor:
+        results = list(executor.map(process_model_unpacked, jobs))
+    last_run.update({n: r for n, r in zip(MODELS, results) if r})
+    save_last_run(last_run)
     if not any(results):
         print("CRITICAL: Failed to generate any images.")
         sys.exit(1)